@@ -287,6 +287,9 @@ def create_loss(args):
             rank=args.rank,
             world_size=args.world_size,
             use_horovod=args.horovod,
+            compile_loss=args.compile_loss,
+            chunk_size=args.loss_chunk_size,
+            gemm_dtype=get_cast_dtype(args.loss_gemm_dtype),
         )
     elif "coca" in args.model.lower():
         return CoCaLoss(
@@ -298,6 +301,9 @@ def create_loss(args):
             rank=args.rank,
             world_size=args.world_size,
             use_horovod=args.horovod,
+            compile_loss=args.compile_loss,
+            chunk_size=args.loss_chunk_size,
+            gemm_dtype=get_cast_dtype(args.loss_gemm_dtype),
         )
     return ClipLoss(
         local_loss=args.local_loss,
@@ -306,6 +312,9 @@ def create_loss(args):
         rank=args.rank,
         world_size=args.world_size,
         use_horovod=args.horovod,
+        compile_loss=args.compile_loss,
+        chunk_size=args.loss_chunk_size,
+        gemm_dtype=get_cast_dtype(args.loss_gemm_dtype),
     )
 
 
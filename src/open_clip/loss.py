@@ -1,19 +1,59 @@
+import logging
+
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
 
-try:
-    import torch.distributed.nn
-    from torch import distributed as dist
-
-    has_distributed = True
-except ImportError:
-    has_distributed = False
-
-try:
-    import horovod.torch as hvd
-except ImportError:
-    hvd = None
+# torch.distributed and horovod are imported on the first feature gather, see import_distributed
+has_distributed = None
+dist = None
+hvd = None
+all_gather_into_tensor = None
+reduce_scatter_tensor = None
+
+
+def import_distributed():
+    global has_distributed, dist, hvd, all_gather_into_tensor, reduce_scatter_tensor
+    if has_distributed is not None:
+        return
+    try:
+        import torch.distributed.nn
+        from torch import distributed as dist
+
+        # all_gather_into_tensor / reduce_scatter_tensor were added as the public names for
+        # _all_gather_base / _reduce_scatter_base in PyTorch 1.13
+        all_gather_into_tensor = getattr(dist, 'all_gather_into_tensor', None) or getattr(dist, '_all_gather_base', None)
+        reduce_scatter_tensor = getattr(dist, 'reduce_scatter_tensor', None) or getattr(dist, '_reduce_scatter_base', None)
+        has_distributed = True
+    except ImportError:
+        has_distributed = False
+
+    try:
+        import horovod.torch as hvd
+    except ImportError:
+        hvd = None
+
+
+class AllGatherIntoTensor(torch.autograd.Function):
+    """ Gradient-passing all_gather straight into one (world_size * batch, ...) tensor.
+
+    Unlike torch.distributed.nn.all_gather, there is no per-rank list to concatenate afterwards. The backward
+    reduce-scatters the gradient so each rank receives the sum of all ranks' gradients for its own features.
+    Only used with the nccl backend, see gather_features.
+    """
+
+    @staticmethod
+    def forward(ctx, features, world_size):
+        ctx.world_size = world_size
+        all_features = features.new_empty((world_size * features.shape[0],) + features.shape[1:])
+        all_gather_into_tensor(all_features, features.contiguous())
+        return all_features
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_features = grad_output.new_empty((grad_output.shape[0] // ctx.world_size,) + grad_output.shape[1:])
+        reduce_scatter_tensor(grad_features, grad_output.contiguous())
+        return grad_features, None
 
 
 def gather_features(
@@ -23,46 +63,135 @@ def gather_features(
         gather_with_grad=False,
         rank=0,
         world_size=1,
-        use_horovod=False
+        use_horovod=False,
 ):
+    import_distributed()
     assert has_distributed, 'torch.distributed did not import correctly, please use a PyTorch version with support.'
+    # both modalities share the batch dim, gather them with a single collective instead of one per modality
+    # both are cast to the promoted dtype so the shared buffer never rounds either of them
+    split_sizes = [features_a.shape[1], features_b.shape[1]]
+    dtype = torch.promote_types(features_a.dtype, features_b.dtype)
+    features = torch.cat([features_a.to(dtype), features_b.to(dtype)], dim=1)
     if use_horovod:
         assert hvd is not None, 'Please install horovod'
         if gather_with_grad:
-            all_features_a = hvd.allgather(features_a)
-            all_features_b = hvd.allgather(features_b)
+            all_features = hvd.allgather(features)
         else:
             with torch.no_grad():
-                all_features_a = hvd.allgather(features_a)
-                all_features_b = hvd.allgather(features_b)
-            if not local_loss:
-                # ensure grads for local rank when all_* features don't have a gradient
-                gathered_features_a = list(all_features_a.chunk(world_size, dim=0))
-                gathered_features_b = list(all_features_b.chunk(world_size, dim=0))
-                gathered_features_a[rank] = features_a
-                gathered_features_b[rank] = features_b
-                all_features_a = torch.cat(gathered_features_a, dim=0)
-                all_features_b = torch.cat(gathered_features_b, dim=0)
+                all_features = hvd.allgather(features)
     else:
         # We gather tensors from all gpus
-        if gather_with_grad:
-            all_features_a = torch.cat(torch.distributed.nn.all_gather(features_a), dim=0)
-            all_features_b = torch.cat(torch.distributed.nn.all_gather(features_b), dim=0)
+        # Not every backend implements the tensor collectives (gloo on older PyTorch doesn't), this is also why
+        # torch.distributed.nn.all_gather falls back to all_to_all outside of nccl. The list based all_gather
+        # works everywhere.
+        nccl = dist.get_backend() == 'nccl'
+        if gather_with_grad and nccl and all_gather_into_tensor is not None and reduce_scatter_tensor is not None:
+            all_features = AllGatherIntoTensor.apply(features, world_size)
+        elif gather_with_grad:
+            all_features = torch.cat(torch.distributed.nn.all_gather(features), dim=0)
+        elif nccl and all_gather_into_tensor is not None:
+            # gather straight into one contiguous buffer, avoids the per-rank list and the copy out of it
+            all_features = torch.empty(
+                (world_size * features.shape[0], features.shape[1]), dtype=features.dtype, device=features.device)
+            with torch.no_grad():
+                all_gather_into_tensor(all_features, features.contiguous())
         else:
-            gathered_features_a = [torch.zeros_like(features_a) for _ in range(world_size)]
-            gathered_features_b = [torch.zeros_like(features_b) for _ in range(world_size)]
-            dist.all_gather(gathered_features_a, features_a)
-            dist.all_gather(gathered_features_b, features_b)
-            if not local_loss:
-                # ensure grads for local rank when all_* features don't have a gradient
-                gathered_features_a[rank] = features_a
-                gathered_features_b[rank] = features_b
-            all_features_a = torch.cat(gathered_features_a, dim=0)
-            all_features_b = torch.cat(gathered_features_b, dim=0)
+            # one uninitialized allocation for all ranks, all_gather fills its per-rank views in place
+            all_features = torch.empty(
+                (world_size * features.shape[0], features.shape[1]), dtype=features.dtype, device=features.device)
+            with torch.no_grad():
+                dist.all_gather(list(all_features.view(world_size, *features.shape).unbind(0)), features)
+
+    if not gather_with_grad and not local_loss:
+        # ensure grads for local rank when all_* features don't have a gradient
+        batch_size = features.shape[0]
+        all_features[rank * batch_size:(rank + 1) * batch_size] = features
+
+    all_features_a, all_features_b = all_features.split(split_sizes, dim=1)
+    if features_a.dtype != features_b.dtype:
+        all_features_a = all_features_a.to(features_a.dtype)
+        all_features_b = all_features_b.to(features_b.dtype)
 
     return all_features_a, all_features_b
 
 
+def cross_entropy(logits, labels):
+    # mean cross entropy written as logsumexp minus the label logit, same formulation as the chunked loss
+    lse = torch.logsumexp(logits, dim=1)
+    picked = logits.gather(1, labels.unsqueeze(1)).squeeze(1)
+    return (lse - picked).mean()
+
+
+def transposed_cross_entropy(logits, labels):
+    # cross entropy over the rows of logits.T, reduced along dim 0 so the transpose is never materialized
+    lse = torch.logsumexp(logits, dim=0)
+    picked = logits.gather(0, labels.unsqueeze(0)).squeeze(0)
+    return (lse - picked).mean()
+
+
+class ChunkedCrossEntropy(torch.autograd.Function):
+    """ Cross entropy of logits = logit_scale * features @ all_features.T, computed over row chunks.
+
+    Only the per-row logsumexp is kept for backward, where the logits of each chunk are recomputed,
+    so the (rows, all_rows) logit matrix is never held in memory, only one (chunk_size, all_rows) block.
+    """
+
+    @staticmethod
+    def forward(ctx, features, all_features, logit_scale, labels, chunk_size):
+        num_rows = features.shape[0]
+        # the softmax statistics are accumulated in at least float32
+        dtype = torch.promote_types(features.dtype, torch.float32)
+        lse = torch.empty(num_rows, dtype=dtype, device=features.device)
+        total = torch.zeros((), dtype=dtype, device=features.device)
+        mm_dtype = features.dtype
+        for i in range(0, num_rows, chunk_size):
+            sims = features[i:i + chunk_size] @ all_features.T
+            # under autocast the matmul runs in the autocast dtype, record it for the recompute in backward
+            mm_dtype = sims.dtype
+            logits = logit_scale * sims.to(dtype)
+            lse[i:i + chunk_size] = torch.logsumexp(logits, dim=1)
+            correct = logits.gather(1, labels[i:i + chunk_size].unsqueeze(1)).squeeze(1)
+            total += (lse[i:i + chunk_size] - correct).sum()
+        ctx.save_for_backward(features, all_features, logit_scale, labels, lse)
+        ctx.chunk_size = chunk_size
+        ctx.mm_dtype = mm_dtype
+        return total / num_rows
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        features, all_features, logit_scale, labels, lse = ctx.saved_tensors
+        chunk_size = ctx.chunk_size
+        num_rows = features.shape[0]
+        need_features, need_all_features, need_scale = ctx.needs_input_grad[:3]
+        grad_features = torch.empty_like(features) if need_features else None
+        grad_all_features = torch.zeros_like(all_features) if need_all_features else None
+        grad_scale = torch.zeros((), dtype=lse.dtype, device=features.device) if need_scale else None
+        # backward runs outside autocast, recompute the logits from operands in the forward matmul dtype
+        # or the softmax would not be normalized by the saved logsumexp
+        mm_features = features.to(ctx.mm_dtype)
+        mm_all_features = all_features.to(ctx.mm_dtype)
+
+        for i in range(0, num_rows, chunk_size):
+            chunk = features[i:i + chunk_size]
+            sims = (mm_features[i:i + chunk_size] @ mm_all_features.T).to(lse.dtype)
+            # d loss / d logits = (softmax - one_hot(labels)) / num_rows
+            grad_logits = torch.exp(logit_scale * sims - lse[i:i + chunk_size].unsqueeze(1))
+            grad_logits.scatter_add_(
+                1, labels[i:i + chunk_size].unsqueeze(1), grad_logits.new_full((grad_logits.shape[0], 1), -1.))
+            grad_logits *= grad_output / num_rows
+            if need_scale:
+                grad_scale += (grad_logits * sims).sum()
+            grad_sims = grad_logits * logit_scale
+            if need_features:
+                grad_features[i:i + chunk_size] = grad_sims.to(all_features.dtype) @ all_features
+            if need_all_features:
+                grad_all_features.addmm_(grad_sims.T.to(chunk.dtype), chunk)
+
+        if need_scale:
+            grad_scale = grad_scale.to(logit_scale.dtype).reshape(logit_scale.shape)
+        return grad_features, grad_all_features, grad_scale, None, None
+
+
 class ClipLoss(nn.Module):
 
     def __init__(
@@ -73,6 +202,9 @@ class ClipLoss(nn.Module):
             rank=0,
             world_size=1,
             use_horovod=False,
+            compile_loss=False,
+            chunk_size=None,
+            gemm_dtype=None,
     ):
         super().__init__()
         self.local_loss = local_loss
@@ -81,63 +213,123 @@ class ClipLoss(nn.Module):
         self.rank = rank
         self.world_size = world_size
         self.use_horovod = use_horovod
+        self.compile_loss = compile_loss
+        self.chunk_size = chunk_size
+        self.gemm_dtype = gemm_dtype
+        # whether the device supports gemm_dtype, resolved on the first CUDA call, see use_gemm_dtype
+        self._gemm_dtype_supported = None
 
-        # cache state
-        self.prev_num_logits = 0
+        # cache state, labels per (device, num_logits)
         self.labels = {}
 
+        # Without local_loss and gather_with_grad, the gradients of the other ranks' rows can't reach this
+        # rank, so every rank computes the loss over the full global batch. The local features hold their
+        # own slot of the gathered features, this gives the exact gradient of the global loss.
+        self.full_logits = world_size > 1 and not local_loss and not gather_with_grad
+
+        # resolve the distributed branch once instead of on every step
+        self.get_all_features = self._gather_distributed if world_size > 1 else self._gather_single
+        self.compute_logits = self._compute_logits_distributed if world_size > 1 and not self.full_logits \
+            else self._compute_logits_single
+        self.compute_loss = self._compute_loss_chunked if chunk_size else self._compute_loss
+        if compile_loss:
+            assert hasattr(torch, 'compile'), 'compile_loss requires PyTorch 2.0 or newer.'
+            # let inductor fuse the logit scaling and the cross entropy around the matmuls, the
+            # feature gather stays outside the compiled region
+            self.compute_loss = torch.compile(self.compute_loss, dynamic=False)
+
     def get_ground_truth(self, device, num_logits) -> torch.Tensor:
-        # calculated ground-truth and cache if enabled
-        if self.prev_num_logits != num_logits or device not in self.labels:
-            labels = torch.arange(num_logits, device=device, dtype=torch.long)
-            if self.world_size > 1 and self.local_loss:
-                labels = labels + num_logits * self.rank
+        # calculated ground-truth and cache if enabled, cached labels already include the rank offset
+        labels = self.labels.get((device, num_logits))
+        if labels is None:
+            start = num_logits * self.rank if self.world_size > 1 and not self.full_logits else 0
+            labels = torch.arange(start, start + num_logits, device=device, dtype=torch.long)
             if self.cache_labels:
-                self.labels[device] = labels
-                self.prev_num_logits = num_logits
-        else:
-            labels = self.labels[device]
+                self.labels[(device, num_logits)] = labels
         return labels
 
+    def _gather_single(self, features_a, features_b):
+        return features_a, features_b
+
+    def _gather_distributed(self, features_a, features_b):
+        return gather_features(
+            features_a, features_b,
+            self.local_loss, self.gather_with_grad, self.rank, self.world_size, self.use_horovod)
+
+    def use_gemm_dtype(self, features):
+        if self.gemm_dtype is None or not features.is_cuda:
+            return False
+        if self._gemm_dtype_supported is None:
+            # bfloat16 tensor core matmuls need Ampere (sm80) or newer
+            self._gemm_dtype_supported = \
+                self.gemm_dtype != torch.bfloat16 or torch.cuda.get_device_capability(features.device)[0] >= 8
+        return self._gemm_dtype_supported
+
+    def scaled_logits(self, features, all_features, logit_scale):
+        if self.use_gemm_dtype(features):
+            # The features are L2-normalized, so low precision matmul operands are safe. The logits are
+            # upcast after the matmul, the cross entropy runs in float32.
+            dtype = self.gemm_dtype
+            return ((logit_scale * features).to(dtype) @ all_features.to(dtype).T).float()
+        # logit_scale is applied to the (batch, dim) features ahead of the matmul, never to the larger logits
+        return (logit_scale * features) @ all_features.T
+
+    def _compute_logits_single(self, features_a, features_b, all_features_a, all_features_b, logit_scale):
+        # the second direction is exactly the transpose of the first, contrastive_loss reduces it w/o a copy
+        logits_per_feature_a = self.scaled_logits(features_a, features_b, logit_scale)
+        return logits_per_feature_a, logits_per_feature_a.T
+
+    def _compute_logits_distributed(self, features_a, features_b, all_features_a, all_features_b, logit_scale):
+        # Only the rows of the local batch are needed, without local_loss the gradients for the remaining
+        # rows reach this rank through the backward of the gather.
+        logits_per_feature_a = self.scaled_logits(features_a, all_features_b, logit_scale)
+        logits_per_feature_b = self.scaled_logits(features_b, all_features_a, logit_scale)
+        return logits_per_feature_a, logits_per_feature_b
+
     def get_logits(self, features_a, features_b, logit_scale):
+        all_features_a, all_features_b = self.get_all_features(features_a, features_b)
+        if self.full_logits:
+            features_a, features_b = all_features_a, all_features_b
+        return self.compute_logits(features_a, features_b, all_features_a, all_features_b, logit_scale)
+
+    def contrastive_loss(self, logits_per_feature_a, logits_per_feature_b, labels):
+        if not logits_per_feature_b.is_contiguous() and logits_per_feature_b.T.is_contiguous():
+            # logits_per_feature_b is a transposed view of logits_per_feature_a, stacking it would copy
+            return (
+                cross_entropy(logits_per_feature_a, labels) +
+                transposed_cross_entropy(logits_per_feature_b.T, labels)
+            ) / 2
+        return (
+            cross_entropy(logits_per_feature_a, labels) +
+            cross_entropy(logits_per_feature_b, labels)
+        ) / 2
 
-        if self.world_size > 1:
-            all_features_a, all_features_b = gather_features(
-                features_a, features_b,
-                self.local_loss, self.gather_with_grad, self.rank, self.world_size, self.use_horovod)
-
-            if self.local_loss:
-                logits_per_feature_a = logit_scale * features_a @ all_features_b.T
-                logits_per_feature_b = logit_scale * features_b @ all_features_a.T
-            else:
-                logits_per_feature_a = logit_scale * all_features_a @ all_features_b.T
-                logits_per_feature_b = logits_per_feature_a.T
-        else:
-            logits_per_feature_a = logit_scale * features_a @ features_b.T
-            logits_per_feature_b = logit_scale * features_b @ features_a.T
+    def _compute_loss(self, features_a, features_b, all_features_a, all_features_b, logit_scale, labels):
+        logits_per_feature_a, logits_per_feature_b = self.compute_logits(
+            features_a, features_b, all_features_a, all_features_b, logit_scale)
+        return self.contrastive_loss(logits_per_feature_a, logits_per_feature_b, labels)
+
+    def _compute_loss_chunked(self, features_a, features_b, all_features_a, all_features_b, logit_scale, labels):
+        # same loss as _compute_loss without materializing the logits, see ChunkedCrossEntropy
+        logit_scale = torch.as_tensor(logit_scale, device=features_a.device)
+        return (
+            ChunkedCrossEntropy.apply(features_a, all_features_b, logit_scale, labels, self.chunk_size) +
+            ChunkedCrossEntropy.apply(features_b, all_features_a, logit_scale, labels, self.chunk_size)
+        ) / 2
 
-       
-        return logits_per_feature_a, logits_per_feature_b
+    def forward(self, image_features=None, text_features=None, logit_scale=None, text_a_features=None, text_b_features=None, output_dict=False):
+        # image-text or text-text pairs, whichever the model produced
+        features_a, features_b = (text_a_features, text_b_features) if image_features is None \
+            else (image_features, text_features)
 
+        all_features_a, all_features_b = self.get_all_features(features_a, features_b)
+        if self.full_logits:
+            # the rows of the loss are the whole global batch, see __init__
+            features_a, features_b = all_features_a, all_features_b
 
-    def forward(self, image_features=None, text_features=None, logit_scale=None, text_a_features=None, text_b_features=None, output_dict=False):
-        
-        if image_features is not None and text_features is not None:
-            features_a = image_features
-            features_b = text_features
-        elif text_a_features is not None and text_b_features is not None:
-            features_a = text_a_features
-            features_b = text_b_features
-
-        device = features_a.device
-        logits_per_feature_a, logits_per_feature_b = self.get_logits(features_a, features_b, logit_scale)
-
-        labels = self.get_ground_truth(device, logits_per_feature_a.shape[0])
-
-        total_loss = (
-            F.cross_entropy(logits_per_feature_a, labels) +
-            F.cross_entropy(logits_per_feature_b, labels)
-        ) / 2
+        labels = self.get_ground_truth(features_a.device, features_a.shape[0])
+
+        total_loss = self.compute_loss(features_a, features_b, all_features_a, all_features_b, logit_scale, labels)
 
         return {"contrastive_loss": total_loss} if output_dict else total_loss
 
@@ -154,6 +346,9 @@ class CoCaLoss(ClipLoss):
             rank=0,
             world_size=1,
             use_horovod=False,
+            compile_loss=False,
+            chunk_size=None,
+            gemm_dtype=None,
     ):
         super().__init__(
             local_loss=local_loss,
@@ -161,7 +356,10 @@ class CoCaLoss(ClipLoss):
             cache_labels=cache_labels,
             rank=rank,
             world_size=world_size,
-            use_horovod=use_horovod
+            use_horovod=use_horovod,
+            compile_loss=compile_loss,
+            chunk_size=chunk_size,
+            gemm_dtype=gemm_dtype,
         )
 
         self.clip_loss_weight = clip_loss_weight
@@ -186,8 +384,15 @@ class CoCaLoss(ClipLoss):
 
 class DistillClipLoss(ClipLoss):
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.compile_loss or self.chunk_size:
+            # the distillation loss needs the student logits, forward computes them directly
+            logging.warning('compile_loss and chunk_size are not used by DistillClipLoss, continuing without...')
+
     def dist_loss(self, teacher_logits, student_logits):
-        return -(teacher_logits.softmax(dim=1) * student_logits.log_softmax(dim=1)).sum(dim=1).mean(dim=0)
+        # soft-target cross entropy, computed in one fused log_softmax + nll pass
+        return F.cross_entropy(student_logits, teacher_logits.softmax(dim=1))
 
     def forward(
             self,
@@ -207,10 +412,7 @@ class DistillClipLoss(ClipLoss):
 
         labels = self.get_ground_truth(image_features.device, logits_per_image.shape[0])
 
-        contrastive_loss = (
-            F.cross_entropy(logits_per_image, labels) +
-            F.cross_entropy(logits_per_text, labels)
-        ) / 2
+        contrastive_loss = self.contrastive_loss(logits_per_image, logits_per_text, labels)
 
         distill_loss = (
             self.dist_loss(dist_logits_per_image, logits_per_image) +
@@ -271,6 +271,27 @@ def parse_args(args):
         action="store_true",
         help="enable full distributed gradient for feature gather"
     )
+    parser.add_argument(
+        "--compile-loss",
+        default=False,
+        action="store_true",
+        help="torch.compile the contrastive loss computation (requires PyTorch 2.0+, not used by the distillation "
+             "loss)"
+    )
+    parser.add_argument(
+        "--loss-chunk-size",
+        type=int,
+        default=None,
+        help="compute the contrastive loss over chunks of this many rows without materializing the full logits "
+             "(not used by the distillation loss)"
+    )
+    parser.add_argument(
+        "--loss-gemm-dtype",
+        choices=["bf16", "fp16"],
+        default=None,
+        help="run the logit matmuls of the contrastive loss in this dtype on CUDA, the cross entropy stays in "
+             "float32 (not used with --loss-chunk-size)"
+    )
     parser.add_argument(
         '--force-image-size', type=int, nargs='+', default=None,
         help='Override default image size'
@@ -0,0 +1,203 @@
+import itertools
+from functools import partial
+
+import pytest
+import torch
+from open_clip.loss import ClipLoss, DistillClipLoss, cross_entropy, transposed_cross_entropy
+
+
+def _features(seed=0, dtype=torch.float64):
+    torch.manual_seed(seed)
+    return (
+        torch.nn.functional.normalize(torch.randn(10, 8, dtype=dtype), dim=-1),
+        torch.nn.functional.normalize(torch.randn(10, 8, dtype=dtype), dim=-1),
+    )
+
+
+def _loss_and_grads(loss_fn, features_a, features_b, logit_scale):
+    features_a = features_a.clone().requires_grad_()
+    features_b = features_b.clone().requires_grad_()
+    logit_scale = logit_scale.clone().requires_grad_()
+    loss = loss_fn(features_a, features_b, logit_scale)
+    loss.backward()
+    return loss.detach(), features_a.grad, features_b.grad, logit_scale.grad
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 16])
+def test_chunked_loss_matches_full(chunk_size):
+    features_a, features_b = _features()
+    logit_scale = torch.tensor(10., dtype=torch.float64)
+    expected = _loss_and_grads(ClipLoss(), features_a, features_b, logit_scale)
+    result = _loss_and_grads(ClipLoss(chunk_size=chunk_size), features_a, features_b, logit_scale)
+    for e, r in zip(expected, result):
+        assert torch.allclose(e, r)
+
+
+def _bfloat16_matmul_loss(features_a, features_b, logit_scale):
+    # what autocast does to the logits: bfloat16 matmul operands, softmax statistics in float32
+    logits = logit_scale * (features_a.bfloat16() @ features_b.bfloat16().T).float()
+    labels = torch.arange(features_a.shape[0])
+    return (
+        torch.nn.functional.cross_entropy(logits, labels) +
+        torch.nn.functional.cross_entropy(logits.T, labels)
+    ) / 2
+
+
+@pytest.mark.parametrize("chunk_size", [3, 16])
+def test_chunked_loss_under_autocast(chunk_size):
+    features_a, features_b = _features(dtype=torch.float32)
+    logit_scale = torch.tensor(100.)
+    loss_fn = ClipLoss(chunk_size=chunk_size)
+
+    def autocast_loss_fn(*args):
+        with torch.autocast("cpu", dtype=torch.bfloat16):
+            return loss_fn(*args)
+
+    expected = _loss_and_grads(_bfloat16_matmul_loss, features_a, features_b, logit_scale)
+    result = _loss_and_grads(autocast_loss_fn, features_a, features_b, logit_scale)
+    for e, r in zip(expected, result):
+        assert r.dtype == torch.float32
+        # the recompute in backward must use the forward matmul dtype, the gradient matmuls run in float32
+        assert (e - r).abs().max() <= 1e-2 * e.abs().max()
+
+
+def test_gemm_dtype_falls_back_on_cpu():
+    features_a, features_b = _features(dtype=torch.float32)
+    logit_scale = torch.tensor(10.)
+    expected = _loss_and_grads(ClipLoss(), features_a, features_b, logit_scale)
+    result = _loss_and_grads(ClipLoss(gemm_dtype=torch.bfloat16), features_a, features_b, logit_scale)
+    for e, r in zip(expected, result):
+        assert torch.equal(e, r)
+
+
+def test_gemm_dtype_scales_features_before_matmul(monkeypatch):
+    features_a, features_b = _features(dtype=torch.float32)
+    logit_scale = torch.tensor(10.)
+    loss_fn = ClipLoss(gemm_dtype=torch.bfloat16)
+    monkeypatch.setattr(loss_fn, "use_gemm_dtype", lambda features: True)
+    logits = loss_fn.scaled_logits(features_a, features_b, logit_scale)
+    assert logits.dtype == torch.float32
+    assert torch.equal(logits, ((logit_scale * features_a).bfloat16() @ features_b.bfloat16().T).float())
+
+
+def test_cross_entropy_matches_torch():
+    torch.manual_seed(0)
+    logits = torch.randn(6, 9, dtype=torch.float64)
+    labels = torch.randint(0, 6, (6,))
+    assert torch.allclose(cross_entropy(logits, labels), torch.nn.functional.cross_entropy(logits, labels))
+    assert torch.allclose(
+        transposed_cross_entropy(logits.T, labels), torch.nn.functional.cross_entropy(logits, labels))
+
+
+def test_clip_loss_matches_baseline():
+    features_a, features_b = _features()
+    logit_scale = torch.tensor(10., dtype=torch.float64)
+
+    def baseline(features_a, features_b, logit_scale):
+        labels = torch.arange(features_a.shape[0])
+        return (
+            torch.nn.functional.cross_entropy(logit_scale * features_a @ features_b.T, labels) +
+            torch.nn.functional.cross_entropy(logit_scale * features_b @ features_a.T, labels)
+        ) / 2
+
+    expected = _loss_and_grads(baseline, features_a, features_b, logit_scale)
+    result = _loss_and_grads(ClipLoss(), features_a, features_b, logit_scale)
+    for e, r in zip(expected, result):
+        assert torch.allclose(e, r)
+
+
+def test_distill_loss_matches_baseline():
+    features_a, features_b = _features()
+    dist_features_a, dist_features_b = _features(seed=1)
+    logit_scale = torch.tensor(10., dtype=torch.float64)
+    dist_logit_scale = torch.tensor(20., dtype=torch.float64)
+
+    def dist_loss(teacher_logits, student_logits):
+        return -(teacher_logits.softmax(dim=1) * student_logits.log_softmax(dim=1)).sum(dim=1).mean(dim=0)
+
+    logits_per_image = logit_scale * features_a @ features_b.T
+    dist_logits_per_image = dist_logit_scale * dist_features_a @ dist_features_b.T
+    labels = torch.arange(features_a.shape[0])
+    expected_contrastive = (
+        torch.nn.functional.cross_entropy(logits_per_image, labels) +
+        torch.nn.functional.cross_entropy(logits_per_image.T, labels)
+    ) / 2
+    expected_distill = (
+        dist_loss(dist_logits_per_image, logits_per_image) +
+        dist_loss(dist_logits_per_image.T, logits_per_image.T)
+    ) / 2
+
+    contrastive, distill = DistillClipLoss()(
+        features_a, features_b, logit_scale, dist_features_a, dist_features_b, dist_logit_scale)
+    assert torch.allclose(contrastive, expected_contrastive)
+    assert torch.allclose(distill, expected_distill)
+
+
+def test_ground_truth_rank_offset():
+    loss_fn = ClipLoss(local_loss=True, cache_labels=True, rank=2, world_size=4)
+    device = torch.device("cpu")
+    for _ in range(2):  # the second lookup is served from the cache
+        assert torch.equal(loss_fn.get_ground_truth(device, 5), torch.arange(10, 15))
+    assert torch.equal(loss_fn.get_ground_truth(device, 3), torch.arange(6, 9))
+    assert torch.equal(ClipLoss(rank=2, world_size=1).get_ground_truth(device, 5), torch.arange(5))
+    # without local_loss and gather_with_grad the labels index the full global batch
+    assert torch.equal(ClipLoss(rank=2, world_size=4).get_ground_truth(device, 20), torch.arange(20))
+
+
+def _baseline_loss(features_a, features_b, logit_scale, rows=slice(None), detach_columns=False):
+    # the baseline formula over the given rows of the global batch
+    columns_a, columns_b = (features_a.detach(), features_b.detach()) if detach_columns else (features_a, features_b)
+    labels = torch.arange(features_a.shape[0])[rows]
+    return (
+        torch.nn.functional.cross_entropy(logit_scale * features_a[rows] @ columns_b.T, labels) +
+        torch.nn.functional.cross_entropy(logit_scale * features_b[rows] @ columns_a.T, labels)
+    ) / 2
+
+
+def _distributed_worker(rank, world_size, init_method, chunk_size):
+    torch.distributed.init_process_group("gloo", init_method=init_method, rank=rank, world_size=world_size)
+    features_a, features_b = _features()
+    logit_scale = torch.tensor(10., dtype=torch.float64)
+    batch_size = features_a.shape[0] // world_size
+    rows = slice(rank * batch_size, (rank + 1) * batch_size)
+    full = _loss_and_grads(_baseline_loss, features_a, features_b, logit_scale)
+
+    for local_loss, gather_with_grad in itertools.product([False, True], repeat=2):
+        loss_fn = ClipLoss(
+            local_loss=local_loss,
+            gather_with_grad=gather_with_grad,
+            cache_labels=True,
+            rank=rank,
+            world_size=world_size,
+            chunk_size=chunk_size,
+        )
+        result = _loss_and_grads(loss_fn, features_a[rows], features_b[rows], logit_scale)
+        local = _loss_and_grads(
+            partial(_baseline_loss, rows=rows, detach_columns=not gather_with_grad),
+            features_a, features_b, logit_scale)
+        if not local_loss and not gather_with_grad:
+            # every rank computes the global loss, the local features get its exact gradient
+            expected = full[0], full[1][rows], full[2][rows], full[3]
+        elif gather_with_grad:
+            # the local rows' loss, the gather's backward sums the feature gradients of all ranks' rows
+            expected = local[0], world_size * full[1][rows], world_size * full[2][rows], local[3]
+        else:
+            expected = local[0], local[1][rows], local[2][rows], local[3]
+        for e, r in zip(expected, result):
+            assert torch.allclose(e, r), (local_loss, gather_with_grad)
+
+    torch.distributed.destroy_process_group()
+
+
+@pytest.mark.skipif(not torch.distributed.is_available(), reason="torch.distributed is not available")
+@pytest.mark.parametrize("chunk_size", [None, 3])
+def test_distributed_loss_matches_baseline(chunk_size, tmp_path):
+    world_size = 2
+    init_method = f"file://{tmp_path / 'store'}"
+    torch.multiprocessing.spawn(_distributed_worker, args=(world_size, init_method, chunk_size), nprocs=world_size)
+
+
+def test_distill_loss_warns_on_unused_options(caplog):
+    with caplog.at_level("WARNING"):
+        DistillClipLoss(chunk_size=3)
+    assert "not used by DistillClipLoss" in caplog.text